@@ -0,0 +1,143 @@
+# batch_summary.py
+import asyncio
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+
+from .openai_client import aclient, openai_retry
+from .settings import settings
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_FAILURES = {"failed", "expired", "cancelled"}
+
+# ---------- Batch API helpers ----------
+
+@openai_retry
+async def submit_batch(requests: List[dict]) -> str:
+    """Upload {custom_id, method, url, body} lines as JSONL and start a batch."""
+    data = b"\n".join(orjson.dumps(r) for r in requests)
+    f = await aclient.files.create(file=("batch.jsonl", data), purpose="batch")
+    batch = await aclient.batches.create(
+        input_file_id=f.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    return batch.id
+
+@openai_retry
+async def collect_batch(batch_id: str) -> Optional[Dict[str, str]]:
+    """
+    Return {custom_id: message content} once the batch has finished, or None
+    while it is still running. Requests that errored are left out.
+    """
+    batch = await aclient.batches.retrieve(batch_id)
+    if batch.status in TERMINAL_FAILURES:
+        raise RuntimeError(f"Batch {batch_id} ended with status: {batch.status}")
+    if batch.status != "completed":
+        return None
+
+    out: Dict[str, str] = {}
+    if not batch.output_file_id:
+        return out
+    content = await aclient.files.content(batch.output_file_id)
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        row = orjson.loads(line)
+        resp = row.get("response") or {}
+        if resp.get("status_code") != 200:
+            continue
+        choices = (resp.get("body") or {}).get("choices") or []
+        if choices:
+            out[row["custom_id"]] = choices[0]["message"].get("content") or ""
+    return out
+
+async def cancel_batch(batch_id: str):
+    """Best-effort cancel of a batch nobody is waiting for anymore."""
+    try:
+        await aclient.batches.cancel(batch_id)
+    except Exception as e:
+        print(f"[warn] Could not cancel batch {batch_id}: {e}")
+
+# ---------- Queue + background worker ----------
+
+class BatchSummaryQueue:
+    """
+    Accumulates summary requests and ships them to the Batch API in groups
+    (half the price of realtime calls, results within the 24h window).
+    A single background task flushes pending requests and polls open batches;
+    it starts on the first enqueue and exits when there is nothing left to do.
+    """
+
+    def __init__(self):
+        self._pending: List[dict] = []
+        self._pending_since: Optional[float] = None
+        self._in_flight: Dict[str, List[str]] = {}  # batch_id -> custom_ids
+        self._status: Dict[str, str] = {}           # custom_id -> queued|submitted|completed|failed
+        self._results: Dict[str, str] = {}
+        self._worker: Optional[asyncio.Task] = None
+
+    def enqueue(self, body: dict) -> str:
+        custom_id = f"summary-{uuid.uuid4().hex}"
+        self._pending.append({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body})
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        self._status[custom_id] = "queued"
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        return custom_id
+
+    def get(self, custom_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """Return (status, content). Completed results are handed out once."""
+        status = self._status.get(custom_id)
+        if status in {"completed", "failed"}:
+            self._status.pop(custom_id, None)
+            return status, self._results.pop(custom_id, None)
+        return status, None
+
+    async def _flush(self):
+        lines, self._pending, self._pending_since = self._pending, [], None
+        ids = [r["custom_id"] for r in lines]
+        try:
+            batch_id = await submit_batch(lines)
+        except Exception as e:
+            print(f"[warn] Batch submit failed: {e}")
+            for cid in ids:
+                self._status[cid] = "failed"
+            return
+        self._in_flight[batch_id] = ids
+        for cid in ids:
+            self._status[cid] = "submitted"
+        print(f"[info] Submitted batch {batch_id} with {len(ids)} summaries")
+
+    async def _poll(self):
+        for batch_id, ids in list(self._in_flight.items()):
+            try:
+                results = await collect_batch(batch_id)
+            except Exception as e:
+                print(f"[warn] Batch {batch_id} failed: {e}")
+                results = {}
+            if results is None:
+                continue
+            del self._in_flight[batch_id]
+            for cid in ids:
+                if cid in results:
+                    self._results[cid] = results[cid]
+                    self._status[cid] = "completed"
+                else:
+                    self._status[cid] = "failed"
+
+    async def _run(self):
+        while self._pending or self._in_flight:
+            await asyncio.sleep(min(settings.batch_flush_sec, settings.batch_poll_sec))
+            if self._pending and (
+                len(self._pending) >= settings.batch_max_requests
+                or time.time() - self._pending_since >= settings.batch_flush_sec
+            ):
+                await self._flush()
+            if self._in_flight:
+                await self._poll()
+
+batch_queue = BatchSummaryQueue()
@@ -1,28 +1,35 @@
 import os
 import re
 import time
-from typing import Dict, Optional
+import asyncio
+from typing import AsyncIterator, Dict, Optional, Tuple, Union
 
+import orjson
 from dotenv import load_dotenv, find_dotenv
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from pydantic import BaseModel, Field
-from openai import OpenAI
+
+from .openai_client import aclient, create_chat_completion, openai_retry, request_timeout
+from . import llm_cache
+from .batch_summary import batch_queue
 
 # -----------------------------------------------------------------------------
 # ENV & OPENAI SETUP
 # -----------------------------------------------------------------------------
 
-def get_api_key() -> Optional[str]:
-    """Load env and return the OpenAI API key."""
-    _ = load_dotenv(find_dotenv(), override=False)
-    key = os.getenv("OPENAI_API_KEY")
-    return key
-
-API_KEY = get_api_key()
+# Resolve .env once at import; find_dotenv() walks up the filesystem
+load_dotenv(find_dotenv(), override=False)
+API_KEY = os.getenv("OPENAI_API_KEY")
 if not API_KEY:
     raise RuntimeError("OPENAI_API_KEY not found in environment.")
 
-client = OpenAI(api_key=API_KEY)
+# Small, fast default; point OPENAI_MODEL at a fine-tuned checkpoint to
+# distill a larger model's summaries (see README).
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+# Hard latency budget (seconds) for one summary request
+SUMMARY_TIMEOUT_SEC = float(os.getenv("SUMMARY_TIMEOUT_SEC", "30"))
 
 # Optional: Assistants mode requires an Assistant ID to reuse the assistant
 # across requests. We will create NEW *threads* per request and delete them
@@ -34,11 +41,19 @@ ASSISTANT_ID = os.getenv("ASSISTANT_ID")
 # PARSING & SUMMARIZATION HELPERS
 # -----------------------------------------------------------------------------
 
+# Compiled once; these run per input line / per summary
+_SECTION_RE = re.compile(r'^(\d+\.\s+.*|.*History.*:|.*HPI.*:.*)$', re.IGNORECASE)
+_QA_RE = re.compile(r'^([^:]+):\s*(.+)$')
+_BOLD_RE = re.compile(r'\*\*([^*]+)\*\*')
+_ITAL_RE = re.compile(r'\*([^*]+)\*')
+_HEAD_RE = re.compile(r'#+\s*')
+
 def parse_structured_input(user_input: str) -> Dict[str, Dict[str, str]]:
     """Parse the structured input format into sections and Q&A pairs."""
     sections: Dict[str, Dict[str, str]] = {}
     current_section = None
     current_content: Dict[str, str] = {}
+    last_question: Optional[str] = None
 
     lines = user_input.split('\n')
     for raw in lines:
@@ -46,20 +61,20 @@ def parse_structured_input(user_input: str) -> Dict[str, Dict[str, str]]:
         if not line:
             continue
 
-        section_match = re.match(r'^(\d+\.\s+.*|.*History.*:|.*HPI.*:.*)$', line, re.IGNORECASE)
+        section_match = _SECTION_RE.match(line)
         if section_match:
             if current_section and current_content:
-                sections[current_section] = current_content.copy()
+                # Hand the dict over; a fresh one is started below
+                sections[current_section] = current_content
                 current_content = {}
-            current_section = line.strip()
+            current_section = line
+            last_question = None
         else:
-            qa_match = re.match(r'^([^:]+):\s*(.+)$', line)
+            qa_match = _QA_RE.match(line)
             if qa_match and current_section:
-                question = qa_match.group(1).strip()
-                answer = qa_match.group(2).strip()
-                current_content[question] = answer
-            elif current_section and current_content:
-                last_question = list(current_content.keys())[-1]
+                last_question = qa_match.group(1).strip()
+                current_content[last_question] = qa_match.group(2).strip()
+            elif current_section and last_question is not None:
                 current_content[last_question] += " " + line
 
     if current_section and current_content:
@@ -80,99 +95,195 @@ def build_context(sections: Dict[str, Dict[str, str]]) -> str:
     return context
 
 
+# Stable instructions live in the system message so every request shares the
+# same prefix (eligible for OpenAI prompt caching); only the case data varies.
 BASE_TASK_INSTRUCTIONS = (
-    "You are a medical consultant creating concise, professional clinical summaries in plain text for doctors. "
-    "Treat every request as independent and stateless; do not use or reference prior inputs, outputs, or memories."
-
-    "OUTPUT FORMAT:"
-    "• Return exactly one cohesive paragraph in plain text."
-    "• No headings, lists, bullets, or labeled sections (do not use 'Problem:', 'History:', 'Symptoms:', 'Social:', or 'Findings:')."
-    "• Target length ~5–130 words (may exceed slightly only to include critical safety information)."
-
-    "CONTENT TO COVER (prioritized):"
-    "• Chief complaint and onset/mechanism with clear chronology."
-    "• Key symptoms with severity, location/radiation, and functional impact."
-    "• Pertinent past medical history (and medications/allergies only if clinically relevant)."
-    "• Pertinent social factors (e.g., smoking, occupation) that affect risk or management."
-    "• Critical exam or imaging findings and the most relevant working impression if implied by the data."
-    "• Current/initial treatment and practical next steps/plan."
-
-    "STYLE & SAFETY:"
-    "• Use precise medical terminology without unnecessary jargon; third-person, objective tone."
-    "• Do not invent or infer facts not present in the input; omit unspecified details."
-    "• Exclude normal/negative findings unless they materially change decisions."
-    "• Preserve units, dates, and timeframes as given."
-
-    "EDGE CASES & LENGTH SCALING:"
-    "• If the input is empty, contains only greetings, or has fewer than ~5 clinically meaningful words, return a single plain sentence: "
-    "'No clinically meaningful information was provided to summarize.' (≤25 words)."
-    "• If the input is very short (<40 words), write 1–2 sentences totaling ≤50 words; include only concrete details explicitly present."
-    "• If the input is short (40–120 words), aim for ~60–90 words."
-    "• If the input is longer (>120 words), aim for ~90–130 words."
-    "• In all cases never exceed 130 words; prefer briefer output when source content is sparse."
+    "You are a medical consultant writing concise, doctor-friendly clinical summaries in plain text. "
+    "Treat every request as independent; use only the data provided.\n"
+    "OUTPUT FORMAT:\n"
+    "• Exactly one cohesive plain-text paragraph: no headings, lists, bullets or labels such as 'Problem:' or 'History:'.\n"
+    "CONTENT (prioritized):\n"
+    "• Chief complaint and onset/mechanism with clear chronology.\n"
+    "• Key symptoms with severity, location/radiation, and functional impact.\n"
+    "• Pertinent past history; medications/allergies only if clinically relevant.\n"
+    "• Social factors (e.g., smoking, occupation) that affect risk or management.\n"
+    "• Critical exam/imaging findings and the working impression if implied by the data.\n"
+    "• Current/initial treatment and practical next steps.\n"
+    "STYLE & SAFETY:\n"
+    "• Precise medical terminology, third-person, objective tone.\n"
+    "• Never invent or infer facts; omit unspecified details.\n"
+    "• Exclude normal/negative findings unless they change decisions.\n"
+    "• Preserve units, dates, and timeframes as given.\n"
+    "LENGTH:\n"
+    "• Empty input, greetings only, or <5 clinically meaningful words: reply "
+    "'No clinically meaningful information was provided to summarize.'\n"
+    "• Input <40 words: 1–2 sentences, ≤50 words. 40–120 words: ~60–90 words. >120 words: ~90–130 words.\n"
+    "• Never exceed 130 words unless needed for critical safety information; prefer brevity when the source is sparse."
 )
 
 
-EXAMPLE_SNIPPET = ""
-
-
 def clean_plain_text(text: str) -> str:
     # Remove common markdown artifacts if the model returns them
-    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)
-    text = re.sub(r'\*([^*]+)\*', r'\1', text)
-    text = re.sub(r'#+\s*', '', text)
+    text = _BOLD_RE.sub(r'\1', text)
+    text = _ITAL_RE.sub(r'\1', text)
+    text = _HEAD_RE.sub('', text)
     return text.strip()
 
 
 # --- Chat Completions (stateless) -------------------------------------------
 
-def generate_summary_chat(context: str) -> str:
-    prompt = (
-        "You are a skilled medical professional creating a concise clinical summary for doctors.\n\n"
-        f"MEDICAL DATA:\n{context}\n\n"
-        + BASE_TASK_INSTRUCTIONS
-        + EXAMPLE_SNIPPET
-        + "Ensure the summary is concise, doctor-friendly, and highlights critical details."
-    )
-
-    resp = client.chat.completions.create(
-        model=os.getenv("OPENAI_MODEL", "gpt-3.5-turbo"),  # Use a known supported model as default
-        messages=[
-            {"role": "system", "content": (
-                "You are a medical consultant creating concise summaries. "
-                "Treat every request as independent and stateless. "
-                "Do not rely on prior runs or any memory from earlier inputs." )},
-            {"role": "user", "content": prompt},
+def _chat_request(context: str) -> dict:
+    """chat.completions body for one summary (realtime and Batch API share it)."""
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {"role": "system", "content": BASE_TASK_INSTRUCTIONS},
+            {"role": "user", "content": f"MEDICAL DATA:\n{context}"},
         ],
-        max_tokens=300,
-        temperature=0.1  # Keep deterministic for medical summaries
-    )
-    out = resp.choices[0].message.content or ""
+        "max_tokens": 300,
+        "temperature": 0.1,  # Keep deterministic for medical summaries
+    }
+
+
+# Summaries run at temperature 0.1, so identical inputs (re-uploads, retries)
+# reuse the previous output from the shared LLM cache (see llm_cache.py).
+
+async def stream_summary_chat_async(context: str) -> AsyncIterator[str]:
+    """Yield raw summary text deltas as the model produces them."""
+    request = _chat_request(context)
+    key = llm_cache.make_key(**request)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    # SUMMARY_TIMEOUT_SEC bounds the whole request (retries and every chunk),
+    # not just the gap between bytes; a deadline is used rather than
+    # a single timeout scope because this generator suspends in the caller's task.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SUMMARY_TIMEOUT_SEC
+    timeout = request_timeout(SUMMARY_TIMEOUT_SEC)
+    parts = []
+    try:
+        resp = await asyncio.wait_for(create_chat_completion(**request, stream=True, timeout=timeout), SUMMARY_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Summary exceeded {SUMMARY_TIMEOUT_SEC:g}s") from None
+    async with resp:
+        chunks = resp.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - loop.time()))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Summary exceeded {SUMMARY_TIMEOUT_SEC:g}s") from None
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+
+    # Only cache streams that ran to completion
+    llm_cache.put(key, "".join(parts))
+
+
+async def generate_summary_chat_async(context: str) -> str:
+    out = "".join([delta async for delta in stream_summary_chat_async(context)])
     return clean_plain_text(out)
 
 
+class SummaryStream:
+    """
+    Iterate for {"delta": ...} payloads as the summary streams in; once the
+    iteration finishes, .summary_text holds the cleaned summary. Errors
+    propagate, so each caller formats its own terminal (done/error) event.
+    """
+
+    def __init__(self, context: str):
+        self.context = context
+        self.summary_text: Optional[str] = None
+
+    async def __aiter__(self) -> AsyncIterator[Dict[str, str]]:
+        parts = []
+        async for delta in stream_summary_chat_async(self.context):
+            parts.append(delta)
+            yield {"delta": delta}
+        # Markdown cleanup needs the whole text, so it only applies at the end
+        self.summary_text = clean_plain_text("".join(parts))
+
+
+# --- Fused speaker labelling + summary (one round trip) ---------------------
+
+ROLES_AND_SUMMARY_INSTRUCTIONS = (
+    "\n\nThe MEDICAL DATA is a conversation transcript whose lines start with speaker labels like [Speaker 1].\n"
+    "Also assign each speaker exactly one role from doctor, patient, nurse, other "
+    "(doctor: assesses, orders tests, counsels; patient: describes symptoms; nurse: triage/vitals/logistics; "
+    "other: family/admin/interpreter).\n"
+    'Return ONLY JSON: {"speaker_roles": {"Speaker 1": "doctor|patient|nurse|other", ...}, '
+    '"summary": "<the summary paragraph>"}'
+)
+
+
+def _has_summary(content: str) -> bool:
+    try:
+        data = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return False
+    return isinstance(data, dict) and bool(data.get("summary"))
+
+
+async def generate_roles_and_summary_async(context: str) -> Tuple[Dict[str, str], str]:
+    """
+    Label speakers and summarize in a single JSON-mode call. Returns the raw
+    {speaker: role} dict (callers normalize it) and the cleaned summary.
+    """
+    request = _chat_request(context)
+    request["messages"][0]["content"] = BASE_TASK_INSTRUCTIONS + ROLES_AND_SUMMARY_INSTRUCTIONS
+    request["max_tokens"] = 400  # room for the roles object next to the summary
+    request["response_format"] = {"type": "json_object"}
+
+    try:
+        # wait_for rather than asyncio.timeout(), which needs Python 3.11
+        content = await asyncio.wait_for(
+            llm_cache.cached_chat(**request, timeout=request_timeout(SUMMARY_TIMEOUT_SEC), accept=_has_summary),
+            SUMMARY_TIMEOUT_SEC,
+        )
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Summary exceeded {SUMMARY_TIMEOUT_SEC:g}s") from None
+    data = orjson.loads(content or "{}")
+    summary = clean_plain_text(str(data.get("summary") or ""))
+    if not summary:
+        raise ValueError("Fused response did not include a summary")
+
+    roles = data.get("speaker_roles") or {}
+    return (roles if isinstance(roles, dict) else {}), summary
+
+
+def sse_event(payload: dict) -> str:
+    """Format one Server-Sent Events frame."""
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+
 # --- Assistants API (new thread per request + cleanup) ----------------------
 
-def generate_summary_assistants(context: str, *, timeout_sec: float = 60.0) -> str:
+# Retries re-run the whole flow on a fresh thread; the failed one is deleted below.
+@openai_retry
+async def generate_summary_assistants(context: str, *, timeout_sec: float = 60.0) -> str:
     if not ASSISTANT_ID:
         raise RuntimeError("ASSISTANT_ID env var is required for assistants mode.")
 
-    user_prompt = (
-        f"MEDICAL DATA:\n{context}\n\n"
-        + BASE_TASK_INSTRUCTIONS
-        + EXAMPLE_SNIPPET
-        + "Ensure the summary is concise, doctor-friendly, and highlights critical details."
-    )
+    user_prompt = f"{BASE_TASK_INSTRUCTIONS}\n\nMEDICAL DATA:\n{context}"
 
     # Create a NEW thread per request
-    thread = client.beta.threads.create()
+    thread = await aclient.beta.threads.create()
     try:
-        client.beta.threads.messages.create(
+        await aclient.beta.threads.messages.create(
             thread_id=thread.id,
             role="user",
             content=user_prompt,
         )
-        run = client.beta.threads.runs.create(
+        run = await aclient.beta.threads.runs.create(
             thread_id=thread.id,
             assistant_id=ASSISTANT_ID,
         )
@@ -183,15 +294,15 @@ def generate_summary_assistants(context: str, *, timeout_sec: float = 60.0) -> s
         while status in {"queued", "in_progress", "cancelling"}:
             if time.time() - start > timeout_sec:
                 raise TimeoutError("Assistants run timed out")
-            time.sleep(0.5)
-            run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
+            await asyncio.sleep(0.5)
+            run = await aclient.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
             status = run.status
 
         if status != "completed":
             raise RuntimeError(f"Assistants run failed with status: {status}")
 
         # Fetch the latest assistant message from the thread
-        msgs = client.beta.threads.messages.list(thread_id=thread.id, order="desc", limit=10)
+        msgs = await aclient.beta.threads.messages.list(thread_id=thread.id, order="desc", limit=10)
         for m in msgs.data:
             if m.role == "assistant":
                 # Messages can have multiple content parts; pick text parts
@@ -206,7 +317,7 @@ def generate_summary_assistants(context: str, *, timeout_sec: float = 60.0) -> s
     finally:
         # Always clean up the thread to avoid carrying state
         try:
-            client.beta.threads.delete(thread.id)
+            await aclient.beta.threads.delete(thread.id)
         except Exception:
             pass
 
@@ -217,7 +328,8 @@ def generate_summary_assistants(context: str, *, timeout_sec: float = 60.0) -> s
 
 class SummarizeRequest(BaseModel):
     user_input: str = Field(..., description="Structured medical Q&A text.")
-    mode: str = Field("chat", description="'chat' (default) or 'assistants'.")
+    mode: str = Field("chat", description="'chat' (default), 'assistants' or 'batch'.")
+    stream: bool = Field(False, description="Stream the summary as SSE (chat mode only).")
 
 class SummarizeResponse(BaseModel):
     summary: str
@@ -225,11 +337,21 @@ class SummarizeResponse(BaseModel):
     lines: int
     mode: str
 
-app = FastAPI(title="Clinical Summary API", version="1.0.0")
+class BatchSubmitResponse(BaseModel):
+    custom_id: str
+    status: str
+    mode: str = "batch"
 
+class BatchResultResponse(BaseModel):
+    custom_id: str
+    status: str
+    summary: Optional[str] = None
 
-@app.post("/summarize", response_model=SummarizeResponse)
-def summarize(req: SummarizeRequest):
+app = FastAPI(title="Clinical Summary API", version="1.0.0", default_response_class=ORJSONResponse)
+
+
+@app.post("/summarize", response_model=Union[SummarizeResponse, BatchSubmitResponse])
+async def summarize(req: SummarizeRequest):
     if not req.user_input or not req.user_input.strip():
         raise HTTPException(status_code=400, detail="user_input is required")
 
@@ -239,11 +361,18 @@ def summarize(req: SummarizeRequest):
 
     context = build_context(sections)
 
+    if req.mode == "batch":
+        custom_id = batch_queue.enqueue(_chat_request(context))
+        return BatchSubmitResponse(custom_id=custom_id, status="queued")
+
+    if req.stream and req.mode != "assistants":
+        return StreamingResponse(_summary_events(context, req.mode), media_type="text/event-stream")
+
     try:
         if req.mode == "assistants":
-            summary = generate_summary_assistants(context)
+            summary = await generate_summary_assistants(context)
         else:
-            summary = generate_summary_chat(context)
+            summary = await generate_summary_chat_async(context)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -255,6 +384,33 @@ def summarize(req: SummarizeRequest):
     )
 
 
+@app.get("/summarize/batch/{custom_id}", response_model=BatchResultResponse)
+async def summarize_batch_result(custom_id: str):
+    status, content = batch_queue.get(custom_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown or already collected custom_id")
+    summary = clean_plain_text(content) if content is not None else None
+    return BatchResultResponse(custom_id=custom_id, status=status, summary=summary)
+
+
+async def _summary_events(context: str, mode: str) -> AsyncIterator[str]:
+    stream = SummaryStream(context)
+    try:
+        async for payload in stream:
+            yield sse_event(payload)
+    except Exception as e:
+        yield sse_event({"error": str(e)})
+        return
+    summary = stream.summary_text
+    final = SummarizeResponse(
+        summary=summary,
+        characters=len(summary),
+        lines=len(summary.splitlines()),
+        mode=mode,
+    )
+    yield sse_event({"done": True, **final.model_dump()})
+
+
 # Convenience root endpoint
 @app.get("/")
 def root():
@@ -265,11 +421,13 @@ def root():
             "POST /summarize": {
                 "body": {
                     "user_input": "...structured Q&A...",
-                    "mode": "chat | assistants"
+                    "mode": "chat | assistants | batch",
+                    "stream": "false | true (SSE: {delta} frames, then a final {done, summary, ...} frame)"
                 }
-            }
+            },
+            "GET /summarize/batch/{custom_id}": "status/result of a mode=batch request"
         }
     }
 
 
-# To run: uvicorn fastapi_clinical_summary:app --host 0.0.0.0 --port 8000
+# To run: uvicorn app.fastapi_clinical_summary:app --host 0.0.0.0 --port 8000
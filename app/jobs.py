@@ -0,0 +1,80 @@
+# jobs.py
+import asyncio
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional
+
+from .fastapi_clinical_summary import SummaryStream
+
+# Finished jobs are dropped this long after completion (in-memory, per worker
+# process); expiry is checked whenever a job is started or looked up
+JOB_TTL_SEC = 3600
+
+class SummaryJob:
+    """Summary deltas for one upload; any number of SSE subscribers can replay them."""
+
+    def __init__(self, download_url: str):
+        self.download_url = download_url
+        self.deltas: List[str] = []
+        self.summary_text: Optional[str] = None
+        self.error: Optional[str] = None
+        self.done = False
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Condition()
+
+    async def publish(self, delta: Optional[str] = None, *, done: bool = False):
+        async with self._changed:
+            if delta:
+                self.deltas.append(delta)
+            if done and not self.done:
+                self.done = True
+                self.finished = time.time()
+            self._changed.notify_all()
+
+    async def events(self) -> AsyncIterator[dict]:
+        sent = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: len(self.deltas) > sent or self.done)
+                new, done = self.deltas[sent:], self.done
+            sent += len(new)
+            for d in new:
+                yield {"delta": d}
+            if done and sent == len(self.deltas):
+                if self.error is not None:
+                    yield {"error": self.error, "download_url": self.download_url}
+                else:
+                    yield {"done": True, "summary_text": self.summary_text, "download_url": self.download_url}
+                return
+
+_jobs: Dict[str, SummaryJob] = {}
+
+def _evict_expired():
+    cutoff = time.time() - JOB_TTL_SEC
+    for job_id in [k for k, j in _jobs.items() if j.finished is not None and j.finished < cutoff]:
+        del _jobs[job_id]
+
+def get_job(job_id: str) -> Optional[SummaryJob]:
+    _evict_expired()
+    return _jobs.get(job_id)
+
+async def generate_and_store_summary(job: SummaryJob, context: str):
+    stream = SummaryStream(context)
+    try:
+        async for payload in stream:
+            await job.publish(payload["delta"])
+        job.summary_text = stream.summary_text
+    except Exception as e:
+        job.error = str(e)
+    await job.publish(done=True)
+
+def start_summary_job(context: str, download_url: str) -> str:
+    """Register a job and start streaming its summary in the background."""
+    _evict_expired()
+    job_id = uuid.uuid4().hex
+    job = SummaryJob(download_url)
+    _jobs[job_id] = job
+    job.task = asyncio.create_task(generate_and_store_summary(job, context))
+    return job_id
@@ -0,0 +1,65 @@
+# llm_cache.py
+import atexit
+import hashlib
+from typing import Callable, Optional
+
+import diskcache
+import orjson
+from cachetools import TTLCache
+
+from .settings import settings
+from .openai_client import create_chat_completion
+
+# Two tiers keyed by SHA-256 of the request: an in-process TTL cache and an
+# optional on-disk (SQLite) cache so re-runs across restarts skip the API.
+_memory: TTLCache = TTLCache(maxsize=max(1, settings.llm_cache_size), ttl=settings.llm_cache_ttl_sec)
+_disk: Optional[diskcache.Cache] = (
+    diskcache.Cache(settings.llm_cache_dir)
+    if settings.llm_cache_enabled and settings.llm_cache_persist else None
+)
+
+stats = {"hits": 0, "misses": 0}
+
+def make_key(**request) -> str:
+    """Stable hash of chat.completions parameters (model, messages, temperature, ...)."""
+    return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def get(key: str) -> Optional[str]:
+    if not settings.llm_cache_enabled:
+        return None
+    value = _memory.get(key)
+    if value is None and _disk is not None:
+        value = _disk.get(key)
+        if value is not None:
+            _memory[key] = value
+    stats["hits" if value is not None else "misses"] += 1
+    return value
+
+def put(key: str, value: str):
+    if not settings.llm_cache_enabled:
+        return
+    _memory[key] = value
+    if _disk is not None:
+        _disk.set(key, value, expire=settings.llm_cache_ttl_sec)
+
+async def cached_chat(*, accept: Optional[Callable[[str], bool]] = None, timeout=None, **request) -> str:
+    """
+    Non-streaming chat completion returning message content, served from cache
+    when an identical request was answered before. Content is only stored if
+    accept(content) is true, so unusable answers are retried next time.
+    """
+    key = make_key(**request)
+    content = get(key)
+    if content is not None:
+        return content
+    extra = {"timeout": timeout} if timeout is not None else {}
+    resp = await create_chat_completion(**request, **extra)
+    content = resp.choices[0].message.content or ""
+    if accept is None or accept(content):
+        put(key, content)
+    return content
+
+@atexit.register
+def _log_stats():
+    if stats["hits"] or stats["misses"]:
+        print(f"[info] LLM cache: {stats['hits']} hits, {stats['misses']} misses")
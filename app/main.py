@@ -1,15 +1,19 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.concurrency import run_in_threadpool
 from pathlib import Path
-import tempfile, shutil, os
+import tempfile, os
+import aiofiles
 
-from .pipeline import transcribe_classify_summarize
+from .pipeline import transcribe_classify_summarize, prepare_conversation
+from .fastapi_clinical_summary import SummaryStream, sse_event
+from .jobs import start_summary_job, get_job
 from .settings import settings
 
-app = FastAPI(title="Voice → Roles → Summary")
+app = FastAPI(title="Voice → Roles → Summary", default_response_class=ORJSONResponse)
+
+UPLOAD_CHUNK = 1 << 20  # 1 MiB
 
 # CORS (loosen for local dev; tighten in prod)
 app.add_middleware(
@@ -28,31 +32,31 @@ def home():
     return "<html><body><h3>POST /api/transcribe-and-summarize</h3></body></html>"
 
 @app.post("/api/transcribe-and-summarize")
-async def api_transcribe_and_summarize(file: UploadFile = File(...)):
+async def api_transcribe_and_summarize(file: UploadFile = File(...), stream: bool = False):
     """
-    Same endpoint/contract, but all heavy work runs in a background thread.
-    This keeps the event loop free so many clients can be served concurrently.
+    Same endpoint/contract. Transcription runs in a worker thread and the
+    OpenAI calls are awaited, so the event loop stays free and many clients
+    can be served concurrently.
+
+    With ?stream=true the summary is sent as Server-Sent Events: one
+    {"delta": ...} frame per token chunk, then a final
+    {"done": true, "summary_text": ..., "download_url": ...} frame.
     """
     try:
-        suffix = Path(file.filename).suffix.lower()
-        if suffix not in {".mp3", ".webm", ".wav", ".m4a"}:
-            raise HTTPException(status_code=400, detail="Only .mp3/.webm/.wav/.m4a accepted")
-
-        # Save upload to a temp file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file.filename}") as tmp:
-            shutil.copyfileobj(file.file, tmp)
-            tmp_path = tmp.name
-
-        # ⬇️ Run your whole pipeline off the event loop
-        result = await run_in_threadpool(
-            transcribe_classify_summarize, tmp_path, file.filename
-        )
-
-        # Best-effort temp cleanup
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+        tmp_path = await _save_upload(file)
+
+        if stream:
+            prepared = await prepare_conversation(tmp_path, file.filename)
+            _remove_quietly(tmp_path)
+            return StreamingResponse(
+                _summary_events(prepared.context, prepared.download_url),
+                media_type="text/event-stream",
+            )
+
+        # ⬇️ Async pipeline: blocking steps are offloaded inside it
+        result = await transcribe_classify_summarize(tmp_path, file.filename)
+
+        _remove_quietly(tmp_path)
 
         return {
             "summary_text": result.summary.get("summary_text", ""),
@@ -63,6 +67,72 @@ async def api_transcribe_and_summarize(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/jobs", status_code=202)
+async def api_create_job(file: UploadFile = File(...)):
+    """
+    Return as soon as the transcript is saved:
+    {"job_id", "download_url", "summary_url"}. The summary is generated in
+    the background and streamed from GET /api/jobs/{job_id}/summary.
+    Jobs live in this worker's memory.
+    """
+    try:
+        tmp_path = await _save_upload(file)
+        prepared = await prepare_conversation(tmp_path, file.filename)
+        _remove_quietly(tmp_path)
+        job_id = start_summary_job(prepared.context, prepared.download_url)
+        return {
+            "job_id": job_id,
+            "download_url": prepared.download_url,
+            "summary_url": f"/api/jobs/{job_id}/summary",
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/jobs/{job_id}/summary")
+async def api_job_summary(job_id: str):
+    """SSE: replays deltas produced so far, then follows the live stream."""
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        async for payload in job.events():
+            yield sse_event(payload)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+async def _save_upload(file: UploadFile) -> str:
+    suffix = Path(file.filename).suffix.lower()
+    if suffix not in {".mp3", ".webm", ".wav", ".m4a"}:
+        raise HTTPException(status_code=400, detail="Only .mp3/.webm/.wav/.m4a accepted")
+
+    # Save upload to a temp file (chunked async I/O keeps the event loop free)
+    fd, tmp_path = tempfile.mkstemp(suffix=f"_{file.filename}")
+    os.close(fd)
+    async with aiofiles.open(tmp_path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK):
+            await out.write(chunk)
+    return tmp_path
+
+def _remove_quietly(path: str):
+    # Best-effort temp cleanup
+    try:
+        os.remove(path)
+    except Exception:
+        pass
+
+async def _summary_events(context: str, download_url: str):
+    stream = SummaryStream(context)
+    try:
+        async for payload in stream:
+            yield sse_event(payload)
+    except Exception as e:
+        yield sse_event({"error": str(e), "download_url": download_url})
+        return
+    yield sse_event({"done": True, "summary_text": stream.summary_text, "download_url": download_url})
+
 @app.get("/api/download/{name}")
 def download_txt(name: str):
     p = Path(settings.transcripts_dir) / name
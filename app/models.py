@@ -1,5 +1,5 @@
-from typing import List, Literal, Optional, Dict, Any
-from pydantic import BaseModel, field_validator
+from typing import List, Literal, Optional, Dict, Any, get_args
+from pydantic import BaseModel, field_validator, model_validator
 
 Role = Literal["doctor", "patient", "nurse", "other"]
 
@@ -9,12 +9,13 @@ class Word(BaseModel):
     word: Optional[str] = None
     text: Optional[str] = None
 
-    @field_validator("word", mode="before")
+    @model_validator(mode="before")
     @classmethod
-    def accept_text_as_word(cls, v, values):
-        if v is None and values.get("text"):
-            return values["text"]
-        return v
+    def accept_text_as_word(cls, data):
+        # Transcribe turns carry {"text": ...}; normalize so .word is always set
+        if isinstance(data, dict) and data.get("word") is None and data.get("text"):
+            data = {**data, "word": data["text"]}
+        return data
 
     class Config:
         extra = "allow"
@@ -28,6 +29,19 @@ class ClassifiedTurn(Turn):
     role: Role
     display_name: str
 
+class RoleMappingResponse(BaseModel):
+    """LLM speaker-labelling answer: {"mapping": {"Speaker 1": "doctor", ...}}."""
+    mapping: Dict[str, Role] = {}
+
+    @field_validator("mapping", mode="before")
+    @classmethod
+    def normalize_roles(cls, v):
+        # Models answer "Doctor" / "clinician" etc.; anything not a known role becomes "other"
+        if isinstance(v, dict):
+            roles = get_args(Role)
+            return {k: r if (r := str(role).lower().strip()) in roles else "other" for k, role in v.items()}
+        return v
+
 class TranscribeResult(BaseModel):
     job_name: str
     service: str
@@ -36,6 +50,16 @@ class TranscribeResult(BaseModel):
     transcript_txt_path: str
     download_url: str
 
+class PreparedConversation(BaseModel):
+    """Everything the pipeline produces before the summary step."""
+    job_name: str
+    service: str
+    document_confidence: Optional[float] = None
+    transcript_txt_path: str
+    download_url: str
+    turns: List[ClassifiedTurn]
+    context: str
+
 class PipelineResponse(BaseModel):
     job_name: str
     service: str
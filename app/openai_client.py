@@ -0,0 +1,76 @@
+# openai_client.py
+import asyncio
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+
+from .settings import settings
+
+# One pooled (HTTP/2, keep-alive) connection set shared by every OpenAI caller
+# in the process, so requests reuse warm TLS connections instead of
+# handshaking per client.
+def request_timeout(read: float) -> httpx.Timeout:
+    """
+    Split timeouts so a stalled connection fails fast instead of holding a
+    worker; read applies between bytes, so streams are not cut off early.
+    Pass this (not a bare float) as a per-call timeout= so only read changes.
+    """
+    return httpx.Timeout(read, connect=5.0, write=10.0, pool=5.0)
+
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=settings.openai_max_connections,
+        max_keepalive_connections=settings.openai_max_keepalive_connections,
+    ),
+    timeout=request_timeout(settings.openai_read_timeout),
+)
+
+# SDK-level retries are disabled; openai_retry below is the single retry layer.
+aclient = AsyncOpenAI(api_key=settings.openai_api_key, http_client=http_client, max_retries=0)
+
+# Process-wide cap on in-flight chat requests, to stay under RPM/TPM limits
+# instead of fanning out into a 429 storm under load.
+OPENAI_SEM = asyncio.Semaphore(settings.openai_max_concurrency)
+
+# ---------- Retry policy ----------
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+_backoff = wait_exponential(multiplier=1, min=1, max=30)
+
+def _wait_retry_after(retry_state) -> float:
+    """Prefer the server's Retry-After (seconds) hint; else exponential backoff."""
+    exc = retry_state.outcome.exception()
+    response = getattr(exc, "response", None)
+    if response is not None:
+        try:
+            return min(max(float(response.headers.get("retry-after")), 0.0), 30.0)
+        except (TypeError, ValueError):
+            pass
+    return _backoff(retry_state)
+
+openai_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=_wait_retry_after,
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    reraise=True,
+)
+
+@openai_retry
+async def create_chat_completion(**kwargs):
+    """
+    chat.completions.create gated by OPENAI_SEM, with retry on 429 / 5xx /
+    connection errors. Backoff sleeps happen outside the semaphore. For
+    stream=True the slot is held until the response starts, not for the
+    whole stream.
+    """
+    async with OPENAI_SEM:
+        return await aclient.chat.completions.create(**kwargs)
@@ -1,14 +1,17 @@
 # pipeline.py
 from pathlib import Path
-from typing import Dict, Any, List, Optional
-import uuid, re
+from typing import Dict, Any, List, Optional, Tuple
+import uuid, re, asyncio
 from datetime import datetime
 
+import aiofiles
+import aiofiles.os
+
 from .settings import settings
-from .models import TranscribeResult, Turn, PipelineResponse, ClassifiedTurn
-from .roles import classify_roles, relabel_turns, refine_dialogue_with_llm
+from .models import TranscribeResult, Turn, Word, PipelineResponse, ClassifiedTurn, PreparedConversation
+from .roles import classify_roles, relabel_turns, refine_dialogue_with_llm, mapping_from_llm, classify_and_refine
 from .transcriber import transcribe_uploaded
-from .fastapi_clinical_summary import generate_summary_chat
+from .fastapi_clinical_summary import generate_summary_chat_async, generate_roles_and_summary_async
 
 def _slugify(name: str) -> str:
     base = Path(name).stem
@@ -23,13 +26,22 @@ def _friendly_job_name(original_filename: Optional[str]) -> str:
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     return f"{_slugify(original_filename or 'conversation')}_{ts}_{uuid.uuid4().hex[:6]}"
 
+def _words_to_text(words: Optional[List[Word]]) -> str:
+    # Word's validator already copied "text" into .word, so tokens are uniform
+    return " ".join(tok for w in words or () if w.word and (tok := w.word.strip()))
+
 def _turns_to_text(turns: List[ClassifiedTurn]) -> str:
     return "\n".join(f"[{t.display_name}] {t.text}".strip() for t in turns)
 
-def _save_txt(content: str, friendly_job: str) -> str:
+async def _save_txt(content: str, friendly_job: str) -> str:
     out_name = f"{friendly_job}_conversation.txt"
     out_path = Path(settings.transcripts_dir) / out_name
-    out_path.write_text(content, encoding="utf-8")
+    # Encode once, write once, then rename so downloads never see a partial file
+    data = content.encode("utf-8")
+    tmp_path = out_path.with_suffix(".txt.part")
+    async with aiofiles.open(tmp_path, "wb") as f:
+        await f.write(data)
+    await aiofiles.os.replace(tmp_path, out_path)
     return str(out_path)
 
 def _as_result(obj: Any) -> Dict[str, Any]:
@@ -39,49 +51,90 @@ def _as_result(obj: Any) -> Dict[str, Any]:
     obj.setdefault("download_url", "")
     return obj
 
-def transcribe_classify_summarize(upload_path: str, original_filename: Optional[str] = None) -> PipelineResponse:
-    # 1) Transcribe
-    t: Dict[str, Any] = _as_result(transcribe_uploaded(upload_path))
+async def _transcribe(upload_path: str) -> Tuple[TranscribeResult, List[Turn]]:
+    # 1) Transcribe (blocking boto3/ffmpeg work stays off the event loop)
+    t: Dict[str, Any] = _as_result(await asyncio.to_thread(transcribe_uploaded, upload_path))
     tr = TranscribeResult(**t)
 
-# 2) Base turns
-    def _words_to_text(words):
-        if isinstance(words, list):
-            parts = []
-            for w in words:
-                token = ""
-                if isinstance(w, dict):
-                    token = (w.get("word") or w.get("text") or "").strip()
-                else:
-                    token = (getattr(w, "word", None) or getattr(w, "text", None) or "").strip()
-                if token:
-                    parts.append(token)
-            return " ".join(parts)
-        return str(words or "")
-
+    # 2) Base turns
+    # TranscribeResult(**t) above is the validation boundary; internal copies skip re-validation
     base_turns: List[Turn] = []
     for r in tr.turns:
         text = r.text or _words_to_text(r.words)
-        base_turns.append(Turn(speaker=r.speaker, text=text, words=r.words))
-
-    # 3) Role classification (Speaker→Role)
-    mapping = classify_roles(base_turns)
-    classified: List[ClassifiedTurn] = relabel_turns(base_turns, mapping)
+        base_turns.append(Turn.model_construct(speaker=r.speaker, text=text, words=r.words))
+    return tr, base_turns
 
+async def _refine(classified: List[ClassifiedTurn]) -> List[ClassifiedTurn]:
     # 3b) Holistic LLM refinement: fix labels (doctor/patient/other), flow, cleaning for final .txt
     if settings.role_refiner_enabled:
-        classified = refine_dialogue_with_llm(classified)
+        return await refine_dialogue_with_llm(classified)
+    return classified
 
-    # 4) Save final .txt (updated with refined turns)
-    friendly_job = _friendly_job_name(original_filename)
+async def _label(base_turns: List[Turn]) -> List[ClassifiedTurn]:
+    if settings.role_refiner_enabled:
+        # 3) + 3b) Role classification and refinement share one LLM call
+        return await classify_and_refine(base_turns)
+    # 3) Role classification (Speaker→Role)
+    mapping = await classify_roles(base_turns)
+    return await _refine(relabel_turns(base_turns, mapping))
+
+async def _transcribe_and_label(upload_path: str) -> Tuple[TranscribeResult, List[ClassifiedTurn]]:
+    tr, base_turns = await _transcribe(upload_path)
+    return tr, await _label(base_turns)
+
+def _render(tr: TranscribeResult, classified: List[ClassifiedTurn]) -> str:
     rendered = _turns_to_text(classified)
     if tr.document_confidence is not None:
         rendered = f"Document confidence: {tr.document_confidence:.4f} ({tr.document_confidence*100:.1f}%)\n\n" + rendered
-    conversation_txt_path = _save_txt(rendered, friendly_job)
+    return rendered
+
+def _summary_context(rendered: str) -> str:
+    return f"MEDICAL CASE DATA:\n\n=== HPI / TRANSCRIPT ===\n{rendered}\n"
+
+async def prepare_conversation(upload_path: str, original_filename: Optional[str] = None) -> PreparedConversation:
+    """Steps 1-4: transcribe, label roles, refine and save the .txt (no summary yet)."""
+    tr, classified = await _transcribe_and_label(upload_path)
+
+    # 4) Save final .txt (updated with refined turns)
+    friendly_job = _friendly_job_name(original_filename)
+    rendered = _render(tr, classified)
+    conversation_txt_path = await _save_txt(rendered, friendly_job)
+
+    return PreparedConversation(
+        job_name=tr.job_name,
+        service=tr.service,
+        document_confidence=tr.document_confidence,
+        transcript_txt_path=conversation_txt_path,
+        download_url=f"/api/download/{Path(conversation_txt_path).name}",
+        turns=classified,
+        context=_summary_context(rendered),
+    )
+
+async def transcribe_classify_summarize(upload_path: str, original_filename: Optional[str] = None) -> PipelineResponse:
+    tr, base_turns = await _transcribe(upload_path)
+    friendly_job = _friendly_job_name(original_filename)
+
+    fused = None
+    if settings.fuse_roles_and_summary and settings.openai_api_key:
+        # 3) + 5) One call labels speakers and summarizes the Speaker-labelled transcript
+        speaker_text = "\n".join(f"[{t.speaker}] {t.text or ''}".strip() for t in base_turns)
+        try:
+            fused = await generate_roles_and_summary_async(_summary_context(speaker_text))
+        except Exception as e:
+            print(f"[warn] Fused roles+summary failed: {e}; using separate calls")
 
-    # 5) Summary (OpenAI) - uses refined rendered
-    context = f"MEDICAL CASE DATA:\n\n=== HPI / TRANSCRIPT ===\n{rendered}\n"
-    summary_text = generate_summary_chat(context)
+    if fused is not None:
+        raw_roles, summary_text = fused
+        classified = await _refine(relabel_turns(base_turns, mapping_from_llm(raw_roles, base_turns)))
+        # 4) Save final .txt (updated with refined turns)
+        conversation_txt_path = await _save_txt(_render(tr, classified), friendly_job)
+    else:
+        classified = await _label(base_turns)
+        # 4) + 5) Save final .txt and run the summary (OpenAI) concurrently - both use refined rendered
+        rendered = _render(tr, classified)
+        save_task = asyncio.create_task(_save_txt(rendered, friendly_job))
+        summary_task = asyncio.create_task(generate_summary_chat_async(_summary_context(rendered)))
+        conversation_txt_path, summary_text = await asyncio.gather(save_task, summary_task)
     summary_json = {"summary_text": summary_text}
 
     return PipelineResponse(
@@ -1,17 +1,87 @@
-from typing import Dict, List
-from openai import OpenAI
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import time
+import re
+import orjson
+from pydantic import ValidationError
 from .settings import settings
-from .models import Turn, ClassifiedTurn, Role
-
-client = OpenAI(api_key=settings.openai_api_key)
+from .models import Turn, ClassifiedTurn, Role, RoleMappingResponse
+from .llm_cache import cached_chat
+from .openai_client import request_timeout
+from .batch_summary import BATCH_ENDPOINT, submit_batch, collect_batch, cancel_batch
 
 ROLE_NAMES = {"doctor": "Doctor", "patient": "Patient", "nurse": "Nurse", "other": "Other"}
 
-def _build_role_prompt(turns: List[Turn]) -> str:
-    by_speaker = {}
+# Per-speaker excerpt budget for the role-labelling prompt
+EXCERPT_TOKENS = 400
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+# A full-dialogue rewrite (up to 2000 output tokens) can outlast the default read timeout
+REFINE_TIMEOUT_SEC = 120.0
+
+# Only a loaded encoder is kept; a failed BPE download is retried after a cooldown
+ENCODER_RETRY_SEC = 300.0
+_encoding = None
+_encoder_retry_at = 0.0
+
+def _encoder():
+    # tiktoken fetches its BPE files on first use; without it (or offline) fall back to ~4 chars/token
+    global _encoding, _encoder_retry_at
+    if _encoding is not None or time.monotonic() < _encoder_retry_at:
+        return _encoding
+    try:
+        import tiktoken
+    except ImportError:
+        print("[warn] tiktoken not installed; estimating excerpt tokens from length")
+        _encoder_retry_at = float("inf")
+        return None
+    try:
+        try:
+            _encoding = tiktoken.encoding_for_model(settings.openai_model)
+        except KeyError:
+            _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"[warn] tiktoken unavailable ({e}); estimating excerpt tokens from length, retrying in {ENCODER_RETRY_SEC:g}s")
+        _encoder_retry_at = time.monotonic() + ENCODER_RETRY_SEC
+    return _encoding
+
+def _count_tokens(text: str) -> int:
+    enc = _encoder()
+    return len(enc.encode(text)) if enc is not None else len(text) // 4 + 1
+
+def _speaker_excerpt(texts: List[str]) -> str:
+    """
+    Pack a speaker's most role-informative sentences into EXCERPT_TOKENS:
+    duplicates dropped, sentences with doctor/patient cues first (then longer
+    ones), emitted in their original order.
+    """
+    sentences = list(dict.fromkeys(
+        sent for text in texts for sent in _SENTENCE_SPLIT_RE.split(text.replace("\n", " ").strip()) if sent
+    ))
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(PATIENT_RE.findall(sentences[i])) - len(DOCTOR_RE.findall(sentences[i])), -len(sentences[i])),
+    )
+    chosen, budget = [], EXCERPT_TOKENS
+    for i in ranked:
+        cost = _count_tokens(sentences[i]) + 1
+        if cost <= budget:
+            chosen.append(i)
+            budget -= cost
+    if not chosen and ranked:
+        return sentences[ranked[0]][:EXCERPT_TOKENS * 4]  # one unpunctuated run-on
+    return " ".join(sentences[i] for i in sorted(chosen))
+
+def _texts_by_speaker(turns: List[Turn]) -> Dict[str, List[str]]:
+    """One pass: every speaker in order of first appearance, with its non-blank turn texts."""
+    texts_by_spk: Dict[str, List[str]] = {}
     for t in turns:
-        by_speaker.setdefault(t.speaker, []).append((t.text or "").strip())
-    excerpts = {spk: " ".join([s for s in v if s])[:2000] for spk, v in by_speaker.items()}
+        texts = texts_by_spk.setdefault(t.speaker, [])
+        if t.text and t.text.strip():
+            texts.append(t.text)
+    return texts_by_spk
+
+def _build_role_prompt(texts_by_spk: Dict[str, List[str]]) -> str:
+    excerpts = {spk: _speaker_excerpt(texts) for spk, texts in texts_by_spk.items() if texts}
     bullets = "\n".join([f'- "{spk}": "{excerpts[spk].replace(chr(10), " ")}"' for spk in excerpts])
     return f"""
 You are labeling speakers in a medical conversation.
@@ -37,28 +107,54 @@ Speakers & excerpts:
 {bullets}
 """.strip()
 
-def _heuristic_mapping(turns: List[Turn]) -> Dict[str, Role]:
-    unique = []
-    for t in turns:
-        if t.speaker not in unique:
-            unique.append(t.speaker)
+# One alternation per role, so each speaker's text is scanned once in C
+PATIENT_RE = re.compile(r"i'm feeling|i feel|\bmy\b|dizzy|fever|since |for the past", re.I)
+DOCTOR_RE = re.compile(r"i'll check|we'll run|let me examine|\bbp\b|tests|rule out", re.I)
+
+def _heuristic_with_confidence(texts_by_spk: Dict[str, List[str]]) -> Tuple[Dict[str, Role], float]:
+    """
+    Keyword-count mapping plus the lowest per-speaker confidence, where a
+    speaker's confidence is how one-sided its doctor/patient keyword hits are
+    (0 when it has fewer than ROLE_HEURISTIC_MIN_HITS hits).
+    """
     mapping: Dict[str, Role] = {}
-    for i, spk in enumerate(unique):
+    for i, spk in enumerate(texts_by_spk):
         mapping[spk] = "doctor" if i == 0 else ("patient" if i == 1 else "other")
-    for spk in unique:
-        joined = " ".join([tt.text or "" for tt in turns if tt.speaker == spk]).lower()
-        if any(k in joined for k in ["i'm feeling", "i feel", "my ", "dizzy", "fever", "since ", "for the past"]):
-            mapping[spk] = "patient"
-        if any(k in joined for k in ["i'll check", "we'll run", "let me examine", "bp", "tests", "rule out"]):
-            mapping[spk] = "doctor"
-    return mapping
-
-def classify_roles(turns: List[Turn]) -> Dict[str, Role]:
+    confidence = 1.0 if texts_by_spk else 0.0
+    for spk, texts in texts_by_spk.items():
+        blob = " ".join(texts)
+        p = len(PATIENT_RE.findall(blob))
+        d = len(DOCTOR_RE.findall(blob))
+        if p or d:
+            mapping[spk] = "patient" if p > d else "doctor"
+        hits = p + d
+        confidence = min(confidence, abs(p - d) / hits if hits >= settings.role_heuristic_min_hits else 0.0)
+    return mapping, confidence
+
+def _heuristic_mapping(turns: List[Turn]) -> Dict[str, Role]:
+    return _heuristic_with_confidence(_texts_by_speaker(turns))[0]
+
+def _is_role_mapping(content: str) -> bool:
+    try:
+        return bool(RoleMappingResponse.model_validate_json(content).mapping)
+    except ValidationError:
+        return False
+
+async def classify_roles(turns: List[Turn]) -> Dict[str, Role]:
+    # Short-circuits that need no LLM round trip
+    texts_by_spk = _texts_by_speaker(turns)
+    speakers = list(texts_by_spk)
+    if len(speakers) < 2:
+        return {speakers[0]: "doctor"} if speakers else {}  # single-voice dictation
+    mapping, confidence = _heuristic_with_confidence(texts_by_spk)
     if not settings.openai_api_key:
-        return _heuristic_mapping(turns)
+        return mapping
+    if confidence >= settings.role_heuristic_confidence and {"doctor", "patient"} <= set(mapping.values()):
+        return mapping
     try:
-        prompt = _build_role_prompt(turns)
-        resp = client.chat.completions.create(
+        await asyncio.to_thread(_encoder)  # first use may download BPE files; keep that off the event loop
+        prompt = _build_role_prompt(texts_by_spk)
+        content = await cached_chat(
             model=settings.openai_model,
             messages=[
                 {"role": "system", "content": "You are a careful, deterministic classifier."},
@@ -66,24 +162,27 @@ def classify_roles(turns: List[Turn]) -> Dict[str, Role]:
             ],
             temperature=0.0,
             response_format={"type": "json_object"},
+            accept=_is_role_mapping,
         )
-        import json
-        mapping_raw = json.loads(resp.choices[0].message.content).get("mapping", {})
-        mapping: Dict[str, Role] = {}
-        for spk, role in mapping_raw.items():
-            r = str(role).lower().strip()
-            mapping[spk] = r if r in {"doctor", "patient", "nurse", "other"} else "other"
-        if mapping and all(v == "other" for v in mapping.values()):
-            return _heuristic_mapping(turns)
-        return mapping or _heuristic_mapping(turns)
+        return mapping_from_llm(RoleMappingResponse.model_validate_json(content).mapping, turns)
     except Exception:
+        return mapping
+
+def mapping_from_llm(mapping_raw: Dict[str, str], turns: List[Turn]) -> Dict[str, Role]:
+    """Normalize a model-produced Speaker→role dict; fall back to heuristics if unusable."""
+    mapping: Dict[str, Role] = {}
+    for spk, role in (mapping_raw or {}).items():
+        r = str(role).lower().strip()
+        mapping[spk] = r if r in {"doctor", "patient", "nurse", "other"} else "other"
+    if mapping and all(v == "other" for v in mapping.values()):
         return _heuristic_mapping(turns)
+    return mapping or _heuristic_mapping(turns)
 
 def relabel_turns(turns: List[Turn], mapping: Dict[str, Role]) -> List[ClassifiedTurn]:
     out: List[ClassifiedTurn] = []
     for t in turns:
         role = mapping.get(t.speaker, "other")
-        out.append(ClassifiedTurn(
+        out.append(ClassifiedTurn.model_construct(
             speaker=t.speaker,
             text=t.text,
             words=t.words,
@@ -92,18 +191,7 @@ def relabel_turns(turns: List[Turn], mapping: Dict[str, Role]) -> List[Classifie
         ))
     return out
 
-def refine_dialogue_with_llm(classified_turns: List[ClassifiedTurn]) -> List[ClassifiedTurn]:
-    """
-    Uses LLM with holistic prompt to review the entire conversation: fix labels (doctor/patient/other/third party),
-    correct errors, reorder/split/merge for logical flow, clean text. Outputs new turns list for final .txt.
-    """
-    if not settings.openai_api_key or not classified_turns:
-        return classified_turns  # No-op if no key or empty
-
-    # Build initial formatted dialogue
-    dialogue_input = "\n".join([f"[{t.display_name}] {t.text}" for t in classified_turns if t.text and t.text.strip()])
-
-    system_prompt = """You are a medical professional reviewing a voice-to-text transcription of a doctor–patient conversation. The dialogue may contain errors such as mixed-up speaker labels, merged sentences, or misplaced responses due to transcription inaccuracies. Your task is to carefully read through the conversation and ensure that the dialogue is presented in the correct logical order, accurately distinguishing between the doctor and the patient. Make any necessary corrections to improve clarity and flow, but do not alter the original meaning or intent of the conversation.
+REFINE_SYSTEM_PROMPT = """You are a medical professional reviewing a voice-to-text transcription of a doctor–patient conversation. The dialogue may contain errors such as mixed-up speaker labels, merged sentences, or misplaced responses due to transcription inaccuracies. Your task is to carefully read through the conversation and ensure that the dialogue is presented in the correct logical order, accurately distinguishing between the doctor and the patient. Make any necessary corrections to improve clarity and flow, but do not alter the original meaning or intent of the conversation.
 
 Roles to use: [Doctor] for clinician, [Patient] for the person describing symptoms, [Other] for any third party (nurse, family, etc.).
 
@@ -117,46 +205,186 @@ Format output strictly as:
 - Each turn on a new line: [Doctor|Patient|Other] Cleaned dialogue here.
 - No extra text, explanations, or headers—just the conversation."""
 
-    try:
-        response = client.chat.completions.create(
-            model=settings.openai_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Raw transcript:\n\n{dialogue_input}"},
-            ],
-            temperature=0.1,
-            max_tokens=2000  # Adjust for length
-        )
+def _parse_refined(cleaned_output: str) -> List[ClassifiedTurn]:
+    refined_turns = []
+    for line in cleaned_output.split("\n"):
+        line = line.strip()
+        if line.startswith("[") and "]" in line:
+            # Valid turn
+            role_part, text_part = line.split("]", 1)
+            role_str = role_part[1:].strip()  # e.g., "Doctor"
+            text = text_part.strip()
+            if role_str in ROLE_NAMES.values() and text:
+                role_key = next((k for k, v in ROLE_NAMES.items() if v == role_str), "other")
+                refined_turns.append(ClassifiedTurn.model_construct(
+                    speaker="refined",  # Dummy
+                    text=text,
+                    words=None,  # Not preserved in holistic pass
+                    role=role_key,
+                    display_name=role_str,
+                ))
+    return refined_turns
 
-        cleaned_output = response.choices[0].message.content.strip()
-
-        # Parse into new turns
-        refined_turns = []
-        lines = cleaned_output.split("\n")
-        for line in lines:
-            line = line.strip()
-            if line.startswith("[") and "]" in line and line.endswith("?") or line.endswith(".") or " " in line.split("]", 1)[1]:
-                # Valid turn
-                role_part, text_part = line.split("]", 1)
-                role_str = role_part[1:].strip()  # e.g., "Doctor"
-                text = text_part.strip()
-                if role_str in ROLE_NAMES.values() and text:
-                    role_key = next((k for k, v in ROLE_NAMES.items() if v == role_str), "other")
-                    refined_turns.append(ClassifiedTurn(
-                        speaker="refined",  # Dummy
-                        text=text,
-                        words=None,  # Not preserved in holistic pass
-                        role=role_key,
-                        display_name=role_str,
-                    ))
-
-        if not refined_turns:
-            print("[warn] No valid turns parsed from refinement; falling back")
-            return classified_turns
-
-        print(f"[info] Refined {len(classified_turns)} → {len(refined_turns)} turns")
-        return refined_turns
+def _refine_request(batch: List[ClassifiedTurn]) -> Optional[dict]:
+    # Build initial formatted dialogue
+    dialogue_input = "\n".join([f"[{t.display_name}] {t.text}" for t in batch if t.text and t.text.strip()])
+    if not dialogue_input:
+        return None
+    return {
+        "model": settings.openai_model,
+        "messages": [
+            {"role": "system", "content": REFINE_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Raw transcript:\n\n{dialogue_input}"},
+        ],
+        "temperature": 0.1,
+        "max_tokens": 2000,  # Adjust for length
+    }
 
-    except Exception as e:
-        print(f"[warn] LLM holistic refinement failed: {e}; using original")
-        return classified_turns
\ No newline at end of file
+def _refined_or_original(content: str, batch: List[ClassifiedTurn]) -> List[ClassifiedTurn]:
+    refined = _parse_refined((content or "").strip())
+    if not refined:
+        print("[warn] No valid turns parsed from refinement batch; falling back")
+        return batch
+    return refined
+
+async def _refine_batch(batch: List[ClassifiedTurn]) -> List[ClassifiedTurn]:
+    request = _refine_request(batch)
+    if request is None:
+        return batch
+    content = await cached_chat(**request, timeout=request_timeout(REFINE_TIMEOUT_SEC), accept=lambda c: bool(_parse_refined(c)))
+    return _refined_or_original(content, batch)
+
+async def _refine_via_batch_api(batches: List[List[ClassifiedTurn]]) -> List[List[ClassifiedTurn]]:
+    """
+    Submit every batch as one OpenAI Batch API job and wait for it, at most
+    BATCH_API_MAX_WAIT_SEC; past that the batch is cancelled and TimeoutError
+    raised so the caller can refine in realtime instead.
+    """
+    requests = []
+    for idx, batch in enumerate(batches):
+        body = _refine_request(batch)
+        if body is not None:
+            requests.append({"custom_id": f"turn-{idx}", "method": "POST", "url": BATCH_ENDPOINT, "body": body})
+    if not requests:
+        return batches
+
+    batch_id = await submit_batch(requests)
+    print(f"[info] Submitted refinement batch {batch_id} ({len(requests)} requests); waiting for results")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.batch_api_max_wait_sec
+    while (results := await collect_batch(batch_id)) is None:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            await cancel_batch(batch_id)
+            raise TimeoutError(f"Batch {batch_id} not finished after {settings.batch_api_max_wait_sec}s")
+        await asyncio.sleep(min(settings.batch_poll_sec, remaining))
+
+    out = []
+    for idx, batch in enumerate(batches):
+        content = results.get(f"turn-{idx}")
+        out.append(batch if content is None else _refined_or_original(content, batch))
+    return out
+
+async def refine_dialogue_with_llm(classified_turns: List[ClassifiedTurn]) -> List[ClassifiedTurn]:
+    """
+    Uses LLM with holistic prompt to review the conversation: fix labels (doctor/patient/other/third party),
+    correct errors, reorder/split/merge for logical flow, clean text. Outputs new turns list for final .txt.
+    Long conversations are split into REFINE_BATCH_TURNS-sized batches refined concurrently
+    (bounded by the shared OpenAI semaphore); a failed batch keeps its original turns.
+    With USE_BATCH_API, long conversations go through the OpenAI Batch API instead
+    (cheaper, but waits for the batch to finish).
+    """
+    if not settings.openai_api_key or not classified_turns:
+        return classified_turns  # No-op if no key or empty
+
+    size = settings.refine_batch_turns if settings.refine_batch_turns > 0 else len(classified_turns)
+    batches = [classified_turns[i:i + size] for i in range(0, len(classified_turns), size)]
+
+    if settings.use_batch_api and len(classified_turns) > settings.batch_api_min_turns:
+        try:
+            refined_batches = await _refine_via_batch_api(batches)
+            refined_turns = [t for b in refined_batches for t in b]
+            print(f"[info] Refined {len(classified_turns)} → {len(refined_turns)} turns via Batch API")
+            return refined_turns
+        except Exception as e:
+            print(f"[warn] Batch API refinement failed: {e}; using realtime requests")
+
+    results = await asyncio.gather(*(_refine_batch(b) for b in batches), return_exceptions=True)
+
+    refined_turns: List[ClassifiedTurn] = []
+    for batch, res in zip(batches, results):
+        if isinstance(res, BaseException):
+            print(f"[warn] LLM refinement batch failed: {res}; using original")
+            refined_turns.extend(batch)
+        else:
+            refined_turns.extend(res)
+
+    print(f"[info] Refined {len(classified_turns)} → {len(refined_turns)} turns in {len(batches)} batch(es)")
+    return refined_turns
+
+CLASSIFY_AND_REFINE_SYSTEM_PROMPT = REFINE_SYSTEM_PROMPT.split("\n\nFormat output strictly as:")[0] + """
+
+The transcript below is labelled with raw diarization names ("Speaker 1", "Speaker 2", ...).
+Do two things in one pass and return ONLY a JSON object:
+{
+  "mapping": {"Speaker 1": "doctor|patient|nurse|other", ...},
+  "refined": ["[Doctor|Patient|Other] Cleaned dialogue here.", ...]
+}
+- "mapping": exactly one role per raw speaker name ("doctor": assessing, ordering tests, counseling; "patient": symptoms/experience; "nurse": triage/vitals/logistics; "other": family/admin/interpreter/third party).
+- "refined": the corrected conversation, one string per turn, each starting with its role tag."""
+
+def _parse_classify_and_refine(content: str) -> Tuple[Dict[str, str], List[ClassifiedTurn]]:
+    data = orjson.loads(content)
+    if not isinstance(data, dict):
+        return {}, []
+    mapping_raw = data.get("mapping")
+    refined = data.get("refined")
+    if isinstance(refined, list):
+        refined = "\n".join(str(line) for line in refined)
+    return (
+        mapping_raw if isinstance(mapping_raw, dict) else {},
+        _parse_refined(refined.strip()) if isinstance(refined, str) else [],
+    )
+
+def _classify_and_refine_ok(content: str) -> bool:
+    try:
+        mapping_raw, refined = _parse_classify_and_refine(content)
+    except orjson.JSONDecodeError:
+        return False
+    return bool(mapping_raw and refined)
+
+async def classify_and_refine(turns: List[Turn]) -> List[ClassifiedTurn]:
+    """
+    Role labelling and holistic refinement in a single JSON-mode call, so the
+    transcript is sent once instead of twice. Conversations longer than one
+    refinement batch, Batch API runs and unusable answers go through
+    classify_roles + refine_dialogue_with_llm instead.
+    """
+    dialogue_input = "\n".join(f"[{t.speaker}] {t.text.strip()}" for t in turns if t.text and t.text.strip())
+    single_batch = settings.refine_batch_turns <= 0 or len(turns) <= settings.refine_batch_turns
+    batch_api = settings.use_batch_api and len(turns) > settings.batch_api_min_turns
+    if settings.openai_api_key and dialogue_input and single_batch and not batch_api:
+        try:
+            content = await cached_chat(
+                model=settings.openai_model,
+                messages=[
+                    {"role": "system", "content": CLASSIFY_AND_REFINE_SYSTEM_PROMPT},
+                    {"role": "user", "content": f"Raw transcript:\n\n{dialogue_input}"},
+                ],
+                temperature=0.1,
+                max_tokens=2500,
+                response_format={"type": "json_object"},
+                timeout=request_timeout(REFINE_TIMEOUT_SEC),
+                accept=_classify_and_refine_ok,
+            )
+            mapping_raw, refined = _parse_classify_and_refine(content)
+            if refined and mapping_raw:
+                print(f"[info] Labelled and refined {len(turns)} → {len(refined)} turns in one call")
+                return refined
+            if mapping_raw:
+                return await refine_dialogue_with_llm(relabel_turns(turns, mapping_from_llm(mapping_raw, turns)))
+            print("[warn] Combined classify+refine returned no usable mapping; using separate calls")
+        except Exception as e:
+            print(f"[warn] Combined classify+refine failed: {e}; using separate calls")
+    mapping = await classify_roles(turns)
+    return await refine_dialogue_with_llm(relabel_turns(turns, mapping))
@@ -14,6 +14,12 @@ def _get_int(key: str, default: int) -> int:
     except Exception:
         return default
 
+def _get_float(key: str, default: float) -> float:
+    try:
+        return float(os.getenv(key, str(default)))
+    except Exception:
+        return default
+
 class Settings(BaseModel):
     # ---- AWS / S3 ----
     aws_access_key_id: str = os.getenv("AWS_ACCESS_KEY_ID", "")
@@ -45,6 +51,33 @@ class Settings(BaseModel):
     # ---- OpenAI ----
     openai_api_key: str = os.getenv("OPENAI_API_KEY", "")
     openai_model: str = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    openai_max_connections: int = _get_int("OPENAI_MAX_CONNECTIONS", 100)
+    openai_max_keepalive_connections: int = _get_int("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 50)
+    openai_max_concurrency: int = _get_int("OPENAI_MAX_CONCURRENCY", 8)
+    openai_read_timeout: int = _get_int("OPENAI_READ_TIMEOUT", 30)
+
+    # ---- LLM response cache (identical requests skip the API) ----
+    llm_cache_enabled: bool = _get_bool("LLM_CACHE_ENABLED", True)
+    # Off by default: the on-disk cache is plaintext SQLite holding transcripts and summaries (PHI)
+    llm_cache_persist: bool = _get_bool("LLM_CACHE_PERSIST", False)
+    llm_cache_dir: str = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+    llm_cache_size: int = _get_int("LLM_CACHE_SIZE", 1024)
+    llm_cache_ttl_sec: int = _get_int("LLM_CACHE_TTL_SEC", 7 * 24 * 3600)
+
+    # ---- OpenAI Batch API (summary mode="batch", bulk refinement) ----
+    batch_flush_sec: int = _get_int("BATCH_FLUSH_SEC", 30)
+    batch_poll_sec: int = _get_int("BATCH_POLL_SEC", 30)
+    batch_max_requests: int = _get_int("BATCH_MAX_REQUESTS", 100)
+    # Route refinement of long transcripts through the Batch API. The HTTP request
+    # waits for the batch, so it gives up after BATCH_API_MAX_WAIT_SEC and falls
+    # back to realtime refinement.
+    use_batch_api: bool = _get_bool("USE_BATCH_API", False)
+    batch_api_min_turns: int = _get_int("BATCH_API_MIN_TURNS", 50)
+    batch_api_max_wait_sec: int = _get_int("BATCH_API_MAX_WAIT_SEC", 600)
+
+    # ---- Role heuristics (confident keyword matches skip the LLM) ----
+    role_heuristic_min_hits: int = _get_int("ROLE_HEURISTIC_MIN_HITS", 3)
+    role_heuristic_confidence: float = _get_float("ROLE_HEURISTIC_CONFIDENCE", 0.8)
 
     # ---- Output dirs ----
     transcripts_dir: str = os.getenv("TRANSCRIPTS_DIR", "transcripts")
@@ -55,6 +88,11 @@ class Settings(BaseModel):
 
     # ---- NEW: LLM role refiner ----
     role_refiner_enabled: bool = _get_bool("ROLE_REFINER_ENABLED", True)
+    # Turns per refinement request; batches run concurrently (0 = one request)
+    refine_batch_turns: int = _get_int("REFINE_BATCH_TURNS", 40)
+
+    # Label speakers and summarize in one LLM call on the non-streaming path
+    fuse_roles_and_summary: bool = _get_bool("FUSE_ROLES_AND_SUMMARY", True)
 
 settings = Settings()
 
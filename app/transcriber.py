@@ -1,12 +1,17 @@
-import os, re, uuid, json, time, mimetypes
-from typing import Dict, List, Tuple, Optional
+import os, uuid, time, shutil, string, mimetypes, functools, subprocess, random, tempfile
+from typing import IO, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import ijson
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
 from boto3.s3.transfer import TransferConfig, S3Transfer
-from pydub import AudioSegment
 
 from .settings import settings
 
@@ -23,7 +28,10 @@ MEDICAL_SPECIALTIES = {
 
 # ---------- AWS clients (tuned) ----------
 
+@functools.lru_cache(maxsize=1)
 def aws_clients():
+    # Built once per process: boto3 clients are thread-safe, and reusing them keeps
+    # the connection pool (and its warm TLS sessions) across uploads.
     # Bigger HTTP pool + accelerated endpoint for S3
     s3_cfg = {"use_accelerate_endpoint": settings.s3_accelerate}
     botocfg = BotoConfig(
@@ -45,8 +53,20 @@ def aws_clients():
 
 # ---------- Helpers ----------
 
+_JOB_NAME_CHARS = frozenset(string.ascii_letters + string.digits + "._-")
+
+class _JobNameTable(dict):
+    """str.translate table: allowed chars map to themselves, anything else (incl. non-ASCII) to "_"."""
+
+    def __missing__(self, codepoint: int):
+        value = codepoint if chr(codepoint) in _JOB_NAME_CHARS else "_"
+        self[codepoint] = value
+        return value
+
+_JOB_NAME_TABLE = _JobNameTable()
+
 def sanitize_job_name(name: str) -> str:
-    return re.sub(r"[^0-9a-zA-Z._-]", "_", name)
+    return name.translate(_JOB_NAME_TABLE)
 
 def ensure_bucket(s3, bucket: str, region: str):
     try:
@@ -99,21 +119,85 @@ def _is_small_mp3(path: str) -> bool:
     except Exception:
         return False
 
+def _ffmpeg_mp3_args(src_path: str, dest: str) -> List[str]:
+    return [
+        "ffmpeg", "-y", "-loglevel", "error", "-i", src_path,
+        "-vn", "-ac", str(settings.target_channels), "-ar", str(settings.target_sample_rate),
+        "-b:a", settings.target_bitrate, "-f", "mp3", dest,
+    ]
+
+def _needs_reencode(src_path: str) -> bool:
+    return settings.force_reencode or not _is_small_mp3(src_path)
+
 def to_mp3(src_path: str, dest_dir: str) -> str:
     base = os.path.splitext(os.path.basename(src_path))[0]
     mp3_path = os.path.join(dest_dir, f"{base}.mp3")
     os.makedirs(dest_dir, exist_ok=True)
 
-    if (not settings.force_reencode) and _is_small_mp3(src_path):
+    if not _needs_reencode(src_path):
         print("[info] Skipping re-encode: already small MP3")
         return src_path
 
-    audio = AudioSegment.from_file(src_path)
-    audio = audio.set_channels(settings.target_channels).set_frame_rate(settings.target_sample_rate)
-    audio.export(mp3_path, format="mp3", bitrate=settings.target_bitrate)
+    # Single streaming ffmpeg pass (no decoded PCM held in Python memory)
+    tmp_path = mp3_path + ".part"
+    try:
+        subprocess.run(
+            _ffmpeg_mp3_args(src_path, tmp_path),
+            check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+    except subprocess.CalledProcessError as e:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise RuntimeError(f"ffmpeg failed: {e.stderr.decode(errors='replace').strip()}") from e
+    os.replace(tmp_path, mp3_path)
     print("[info] Re-encoded to optimized MP3")
     return mp3_path
 
+def start_mp3_encoder(src_path: str) -> Tuple[subprocess.Popen, IO[bytes]]:
+    """
+    ffmpeg re-encoding src_path to MP3 on its stdout (read it with upload_mp3_stream).
+    stderr goes to a temp file: a pipe nobody drains while stdout is consumed can
+    fill up on a noisy decode and stall ffmpeg (and the upload) forever.
+    """
+    err_file = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(
+            _ffmpeg_mp3_args(src_path, "pipe:1"),
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=err_file,
+        )
+    except BaseException:
+        err_file.close()
+        raise
+    return proc, err_file
+
+def upload_mp3_stream(s3, proc: subprocess.Popen, err_file: IO[bytes], bucket: str, key: str) -> str:
+    """Multipart-upload the encoder's stdout straight to S3 (no intermediate MP3 on disk)."""
+    try:
+        try:
+            s3.upload_fileobj(
+                proc.stdout, bucket, key,
+                ExtraArgs={"ContentType": "audio/mpeg"},
+                Config=_transfer_config(),
+            )
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            # Truncated audio must not reach Transcribe
+            s3.delete_object(Bucket=bucket, Key=key)
+            err_file.seek(0, os.SEEK_END)
+            err_file.seek(max(0, err_file.tell() - 4096))
+            raise RuntimeError(f"ffmpeg failed: {err_file.read().decode(errors='replace').strip()}")
+    finally:
+        err_file.close()
+    print("[info] Re-encoded and streamed MP3 to S3")
+    return f"s3://{bucket}/{key}"
+
 # ---------- Transcribe ----------
 
 def start_job(transcribe, media_s3_uri: str, safe_base: str) -> Tuple[str, str]:
@@ -132,14 +216,7 @@ def start_job(transcribe, media_s3_uri: str, safe_base: str) -> Tuple[str, str]:
                 "ShowAlternatives": True,
                 "MaxAlternatives": 2,
             },
-            "Specialty": {
-                "primarycare": "PRIMARYCARE",
-                "cardiology": "CARDIOLOGY",
-                "neurology": "NEUROLOGY",
-                "oncology": "ONCOLOGY",
-                "radiology": "RADIOLOGY",
-                "urology": "UROLOGY",
-            }.get(settings.specialty, "PRIMARYCARE"),
+            "Specialty": MEDICAL_SPECIALTIES.get(settings.specialty, "PRIMARYCARE"),
             "Type": "CONVERSATION",
         }
         transcribe.start_medical_transcription_job(**args)
@@ -162,25 +239,47 @@ def start_job(transcribe, media_s3_uri: str, safe_base: str) -> Tuple[str, str]:
         transcribe.start_transcription_job(**args)
         return job_name, "transcribe"
 
-def wait_for_job(transcribe, job_name: str, service: str, poll_sec: int = 3, timeout_min: int = 120) -> dict:
+THROTTLE_CODES = {"ThrottlingException", "TooManyRequestsException", "LimitExceededException", "RequestLimitExceeded"}
+
+def wait_for_job(transcribe, job_name: str, service: str, first_poll_sec: float = 1.0,
+                 max_poll_sec: float = 30.0, timeout_min: int = 120) -> dict:
+    # Exponential backoff with jitter: short jobs are noticed quickly, long ones
+    # need far fewer Get*TranscriptionJob calls than a fixed interval
     deadline = time.time() + timeout_min * 60
+    delay = first_poll_sec
     while time.time() < deadline:
-        if service == "medical":
-            resp = transcribe.get_medical_transcription_job(MedicalTranscriptionJobName=job_name)
-            job = resp["MedicalTranscriptionJob"]
+        try:
+            if service == "medical":
+                resp = transcribe.get_medical_transcription_job(MedicalTranscriptionJobName=job_name)
+                job = resp["MedicalTranscriptionJob"]
+            else:
+                resp = transcribe.get_transcription_job(TranscriptionJobName=job_name)
+                job = resp["TranscriptionJob"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in THROTTLE_CODES:
+                raise
+            print("[warn] Transcribe polling throttled; backing off")
+            delay = min(max_poll_sec, delay * 2)
         else:
-            resp = transcribe.get_transcription_job(TranscriptionJobName=job_name)
-            job = resp["TranscriptionJob"]
-        status = job["TranscriptionJobStatus"]
-        if status in ("COMPLETED", "FAILED"):
-            return job
-        time.sleep(poll_sec)
+            status = job["TranscriptionJobStatus"]
+            if status in ("COMPLETED", "FAILED"):
+                return job
+        time.sleep(min(delay + random.uniform(0, delay * 0.1), max(0.0, deadline - time.time())))
+        delay = min(max_poll_sec, delay * 1.5)
     raise TimeoutError(f"Job timed out: {job_name}")
 
 # ---------- Download transcript ----------
 
-def download_transcript(s3, url: str, dest_path: str):
-    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+# Shared pool for non-S3 transcript URLs, so repeat downloads reuse TLS connections
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+))
+
+def _open_transcript(s3, url: str):
+    """Readable byte stream over the transcript JSON (S3 object body or HTTP response)."""
     if url.startswith("s3://") or "amazonaws.com" in url:
         if url.startswith("s3://"):
             bucket, key = url[5:].split("/", 1)
@@ -189,14 +288,43 @@ def download_transcript(s3, url: str, dest_path: str):
             parsed = urlparse(url)
             parts = parsed.path.lstrip("/").split("/", 1)
             bucket, key = parts[0], parts[1]
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        body = obj["Body"].read()
-    else:
-        r = requests.get(url, timeout=300)
+        return s3.get_object(Bucket=bucket, Key=key)["Body"]
+    r = _HTTP.get(url, timeout=300, stream=True)
+    try:
         r.raise_for_status()
-        body = r.content
-    with open(dest_path, "wb") as f:
-        f.write(body)
+    except BaseException:
+        r.close()  # release the pooled connection
+        raise
+    r.raw.decode_content = True
+    return r.raw
+
+def download_transcript(s3, url: str, dest_path: str):
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    body = _open_transcript(s3, url)
+    try:
+        with open(dest_path, "wb") as f:
+            shutil.copyfileobj(body, f, 1 << 20)
+    finally:
+        body.close()
+
+def load_results(s3, url: str, json_path: str) -> dict:
+    """
+    The transcript's "results" object. Parsed incrementally from the network
+    stream (no raw copy in memory, nothing on disk) unless raw files are kept,
+    in which case the JSON is saved to json_path and parsed from there.
+    """
+    if settings.keep_raw_files:
+        download_transcript(s3, url, json_path)
+        with open(json_path, "rb") as f:
+            return orjson.loads(f.read()).get("results", {})
+    body = _open_transcript(s3, url)
+    try:
+        for key, value in ijson.kvitems(body, "", use_float=True):
+            if key == "results":
+                return value
+    finally:
+        body.close()
+    return {}
 
 # ---------- Formatting ----------
 
@@ -210,19 +338,27 @@ def build_speaker_map(speaker_labels: dict) -> Dict[str, str]:
                 ts_to_spk[start] = spk
     return ts_to_spk
 
+def _item_confidence(it: dict):
+    if it.get("type") != "pronunciation":
+        return None
+    c = (it.get("alternatives") or [{}])[0].get("confidence")
+    return c if isinstance(c, (int, float, str)) else None
+
+def _is_number(v) -> bool:
+    try:
+        float(v)
+        return True
+    except (TypeError, ValueError):
+        return False
+
 def doc_confidence(results: dict) -> float:
-    items = results.get("items", [])
-    vals: List[float] = []
-    for it in items:
-        if it.get("type") == "pronunciation":
-            alt = it.get("alternatives", [{}])[0]
-            c = alt.get("confidence")
-            if c is not None:
-                try:
-                    vals.append(float(c))
-                except (TypeError, ValueError):
-                    pass
-    return sum(vals)/len(vals) if vals else 1.0
+    raw = [c for c in map(_item_confidence, results.get("items", [])) if c is not None]
+    try:
+        confs = np.fromiter(raw, dtype=np.float64, count=len(raw))
+    except ValueError:
+        # A malformed value somewhere: drop only the unparsable entries
+        confs = np.array([v for v in raw if _is_number(v)], dtype=np.float64)
+    return float(confs.mean()) if confs.size else 1.0
 
 def pretty_turns(results: dict) -> List[dict]:
     items = results.get("items", [])
@@ -234,87 +370,100 @@ def pretty_turns(results: dict) -> List[dict]:
         return [{"speaker": "Speaker 1", "words": [{"text": w} for w in text.split()], "text": text}]
 
     ts_to_spk = build_speaker_map(speaker_labels)
-    spk_index: Dict[str, int] = {}
-
-    def spk_name(lbl: Optional[str]) -> Optional[str]:
-        if lbl is None:
-            return None
-        if lbl not in spk_index:
-            spk_index[lbl] = len(spk_index) + 1
-        return f"Speaker {spk_index[lbl]}"
-
-    turns: List[dict] = []
-    current_speaker: Optional[str] = None
-    current_words: List[dict] = []
-
-    def flush():
-        nonlocal current_speaker, current_words
-        if current_speaker and current_words:
-            text = " ".join(w["text"] for w in current_words)
-            turns.append({"speaker": current_speaker, "words": current_words, "text": text})
-            current_words = []
+    spk_index: Dict[str, int] = {}  # label -> 0-based index, in order of first appearance
 
+    # Flatten once: pronunciation tokens + their speaker index (-1 = unlabelled),
+    # and each punctuation mark with the pronunciation it follows
+    tokens: List[str] = []
+    codes: List[int] = []
+    punct_after: List[Tuple[int, str]] = []
     for it in items:
         typ = it.get("type")
         if typ == "pronunciation":
-            alt = it["alternatives"][0]
-            word = alt["content"]
-            start_time = it.get("start_time")
-            spk = spk_name(ts_to_spk.get(start_time)) or current_speaker or "Speaker 1"
-            if spk != current_speaker:
-                flush()
-                current_speaker = spk
-            current_words.append({"text": word})
+            tokens.append(it["alternatives"][0]["content"])
+            lbl = ts_to_spk.get(it.get("start_time"))
+            codes.append(-1 if lbl is None else spk_index.setdefault(lbl, len(spk_index)))
         elif typ == "punctuation":
-            punct = it["alternatives"][0]["content"]
-            if current_words:
-                current_words[-1]["text"] = current_words[-1]["text"] + punct
-            else:
-                current_words.append({"text": punct})
-    flush()
+            punct_after.append((len(tokens) - 1, it["alternatives"][0]["content"]))
+    if not tokens:
+        return []
+
+    # Unlabelled words keep the running speaker ("Speaker 1" before any label);
+    # a turn starts wherever the forward-filled speaker changes
+    spk = np.asarray(codes, dtype=np.int32)
+    labelled = spk >= 0
+    last_labelled = np.maximum.accumulate(np.where(labelled, np.arange(spk.size), -1))
+    spk = np.where(last_labelled >= 0, spk[np.maximum(last_labelled, 0)], 0)
+    starts = np.flatnonzero(np.diff(spk, prepend=-1))
+    ends = np.append(starts[1:], spk.size)
+
+    leading = ""  # punctuation before the first word becomes its own token
+    for owner, punct in punct_after:
+        if owner >= 0:
+            tokens[owner] += punct
+        else:
+            leading += punct
+
+    turns: List[dict] = []
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        turn_tokens = [leading] + tokens[start:end] if leading and not i else tokens[start:end]
+        turns.append({
+            "speaker": f"Speaker {int(spk[start]) + 1}",
+            "words": [{"text": tok} for tok in turn_tokens],
+            "text": " ".join(turn_tokens),
+        })
     return turns
 
 # ---------- Orchestration ----------
 
-def transcribe_uploaded(local_path: str) -> Dict:
+def _prepare_aws():
     s3, transcribe = aws_clients()
     ensure_bucket(s3, settings.bucket, settings.region)
     if settings.s3_accelerate:
         ensure_acceleration(s3, settings.bucket)
+    return s3, transcribe
 
-    # 1) Convert (or skip) to small MP3
-    mp3_path = to_mp3(local_path, settings.local_audio_dir)
-
-    # 2) Upload (accelerated + multipart + threads)
-    base = os.path.basename(mp3_path)
+def transcribe_uploaded(local_path: str) -> Dict:
+    # Re-encoded audio goes from ffmpeg's stdout straight to S3; a local MP3 is
+    # only written when raw files are kept (or the input is already a small MP3)
+    stream_upload = _needs_reencode(local_path) and not settings.keep_raw_files
+
+    # 1) + 2) Convert (or skip) to small MP3 while clients + bucket checks run alongside,
+    # then upload (accelerated + multipart + threads)
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        aws_future = ex.submit(_prepare_aws)
+        if stream_upload:
+            base = f"{os.path.splitext(os.path.basename(local_path))[0]}.mp3"
+            proc, err_file = start_mp3_encoder(local_path)
+            try:
+                s3, transcribe = aws_future.result()
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                err_file.close()
+                raise
+            media_uri = upload_mp3_stream(s3, proc, err_file, settings.bucket, f"input/{base}")
+        else:
+            mp3_path = to_mp3(local_path, settings.local_audio_dir)
+            s3, transcribe = aws_future.result()
+            base = os.path.basename(mp3_path)
+            media_uri = upload_file_to_s3(s3, mp3_path, settings.bucket, f"input/{base}")
     safe_base = sanitize_job_name(os.path.splitext(base)[0])
-    key = f"input/{base}"
-    media_uri = upload_file_to_s3(s3, mp3_path, settings.bucket, key)
 
     # 3) Transcribe
     job_name, service = start_job(transcribe, media_uri, safe_base)
-    job = wait_for_job(transcribe, job_name, service, poll_sec=3)
+    job = wait_for_job(transcribe, job_name, service)
     if job.get("TranscriptionJobStatus") == "FAILED":
         raise RuntimeError(job.get("FailureReason", "Unknown failure"))
 
     transcript_url = job["Transcript"]["TranscriptFileUri"]
 
-    # 4) Download JSON locally (only to parse; remove unless keeping raw)
+    # 4) Stream-parse the transcript JSON (saved locally only when keeping raw files)
     json_path = os.path.join(settings.output_dir, f"{safe_base}_{service}.json")
-    download_transcript(s3, transcript_url, json_path)
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    results = data.get("results", {})
+    results = load_results(s3, transcript_url, json_path)
     turns = pretty_turns(results)
     conf = doc_confidence(results)
 
-    if not settings.keep_raw_files:
-        try:
-            os.remove(json_path)
-        except Exception:
-            pass
-
     return {
         "job_name": job_name,
         "service": "medical" if settings.use_medical else "standard",